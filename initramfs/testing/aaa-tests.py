@@ -15,23 +15,65 @@
 
 """Unit tests for initrd shell scripts."""
 
-from helpers import VMShellTestCase, main
-
-
-class UbuntuCoreFunctionsTests(VMShellTestCase):
-    """Tests for shell code in ubuntu-core-functions."""
+import sys
+
+import pytest
+
+from helpers import LocalShellTestCase, ShellTestCase, VMShellTestCase
+
+# Shell making the "some-label" label resolve to /dev/null.
+_SOME_LABEL_SYMLINK = "ln -sf /dev/null /dev/some-label"
+
+# Calls to mocks expected by the tests below.
+_PRE_MOUNTROOT_CALLS = (
+    ("log_begin_msg", "Running /scripts/local-top"),
+    ("run_scripts", "/scripts/local-top"),
+    ("log_end_msg",),
+)
+_PRE_MOUNTROOT_QUIET_CALLS = (
+    ("run_scripts", "/scripts/local-top"),
+)
+_WAIT_FOR_LABEL_CALLS = (
+    ("wait-for-root", "LABEL=some-label", "180"),
+)
+_WAIT_FOR_LABEL_ROOTDELAY_CALLS = (
+    ("wait-for-root", "LABEL=some-label", "123"),
+)
+_NEED_LABEL_CALLS = (
+    ("panic", "need FS label"),
+)
+_DO_ROOT_MOUNTING_UNSET_LABEL_CALLS = (
+    ("wait-for-root", "LABEL=", "180"),
+    ("findfs", "LABEL="),
+    ("panic", "root device  does not exist"),
+)
+_DO_ROOT_MOUNTING_FAILING_WAIT_CALLS = (
+    ("wait-for-root", "LABEL=some-label", "180"),
+    ("panic", "unable to find root partition 'LABEL=some-label'"),
+)
+_DO_ROOT_MOUNTING_CALLS = (
+    ("wait-for-root", "LABEL=some-label", "180"),
+    ("findfs", "LABEL=some-label"),
+    ("modprobe", "squashfs"),
+    ("wait-for-root", "LABEL=some-label", "180"),
+    ("mount", "/dev/null", "/fake-writable-mnt"),
+)
+
+
+class UbuntuCoreFunctionsTestCase(ShellTestCase):
+    """Common setup for testing shell code in ubuntu-core-functions."""
 
     MOCK = ("log_begin_msg", "log_end_msg", "run_scripts", "wait-for-root")
 
-    def setUp(self) -> None:
+    def sh_setup(self) -> None:
         """
-        Prepare each test for exaction.
+        Prepare shell code shared by all the tests.
 
         This mocks some shell functions and executables (those listed in MOCK)
         as well as the panic command. It also sources the "ubuntu-core-rootfs"
-        script so that it can be easily tested.
+        script so that it can be easily tested. This is done once for the
+        whole class, each test starts with a copy of the result.
         """
-        super().setUp()
         # Test certain functions are mocked.
         for fn in self.MOCK:
             self.sh_mock(fn)
@@ -40,16 +82,16 @@ class UbuntuCoreFunctionsTests(VMShellTestCase):
         # Source ubuntu-core-rootfs
         self.sh_source("/scripts/ubuntu-core-rootfs")
 
+
+class PreMountrootTests(UbuntuCoreFunctionsTestCase, LocalShellTestCase):
+    """Tests for pre_mountroot, which is pure shell and runs on the host."""
+
     def test_pre_mountroot__works(self) -> None:
         """Test pre_mountroot runs local-top scripts."""
         returncode, log = self.sh_run("pre_mountroot")
         self.assertEqual(returncode, 0)
         self.assertEqual(log, [])
-        self.assertEqual(self.sh_mocked_calls(), [
-            ("log_begin_msg", "Running /scripts/local-top"),
-            ("run_scripts", "/scripts/local-top"),
-            ("log_end_msg",),
-        ])
+        self.assertEqual(self.sh_mocked_calls(), _PRE_MOUNTROOT_CALLS)
 
     def test_pre_mountroot__respects_quiet(self) -> None:
         """Test pre_mountroot doesn't log with quiet=y."""
@@ -58,62 +100,93 @@ class UbuntuCoreFunctionsTests(VMShellTestCase):
         # XXX: error code left-over from [ ] used inside pre_mountroot()
         self.assertEqual(returncode, 1)
         self.assertEqual(log, [])
-        self.assertEqual(self.sh_mocked_calls(), [
-            ("run_scripts", "/scripts/local-top"),
-        ])
+        self.assertEqual(self.sh_mocked_calls(), _PRE_MOUNTROOT_QUIET_CALLS)
+
+
+class DoRootMountingPanicTests(UbuntuCoreFunctionsTestCase,
+                               LocalShellTestCase):
+    """
+    Tests for do_root_mounting giving up early.
+
+    Those tests panic before anything in /dev or /proc is used so they can
+    run on the host. Finding the root device is mocked so that it never
+    looks at block devices of the host.
+    """
+
+    def sh_setup(self) -> None:
+        """Prepare shell code shared by all the tests, mocking findfs too."""
+        super().sh_setup()
+        self.sh_mock("findfs")
+
+    def test_do_root_mounting__with_unset_writable_label(self) -> None:
+        """Test do_root_mounting panics when writable_label is unset."""
+        returncode, log = self.sh_run("do_root_mounting")
+        self.assertEqual(returncode, 150)
+        self.assertEqual(log, [])
+        self.assertEqual(
+            self.sh_mocked_calls(), _DO_ROOT_MOUNTING_UNSET_LABEL_CALLS)
+
+    def test_do_root_mounting__with_failing_wait_for_root(self) -> None:
+        """Test do_root_mounting panics when writable_label is unset."""
+        self.sh_mock("wait-for-root", returns=10)
+        self.sh_inject("writable_label=some-label")
+        returncode, log = self.sh_run("do_root_mounting")
+        self.assertEqual(returncode, 150)
+        self.assertEqual(log, [])
+        self.assertEqual(
+            self.sh_mocked_calls(), _DO_ROOT_MOUNTING_FAILING_WAIT_CALLS)
+
+
+class UbuntuCoreFunctionsTests(UbuntuCoreFunctionsTestCase, VMShellTestCase):
+    """
+    Tests for shell code in ubuntu-core-functions.
+
+    Those tests need a virtual machine as they look at (and change) /dev and
+    /proc.
+    """
 
     def test_get_partition_from_label__works(self) -> None:
         """Test get_partition_from_label when working normally."""
         # NOTE: the device has to actually exist as the code uses "readlink -f"
         # to canonicalize it.
-        self.sh_inject("ln -s /dev/null /dev/some-label")
+        self.sh_inject(_SOME_LABEL_SYMLINK)
         returncode, log = self.sh_run("get_partition_from_label some-label")
         self.assertEqual(returncode, 0)
         self.assertEqual(log, [b"/dev/null"])
-        self.assertEqual(self.sh_mocked_calls(), [
-            ("wait-for-root", "LABEL=some-label", "180"),
-        ])
+        self.assertEqual(self.sh_mocked_calls(), _WAIT_FOR_LABEL_CALLS)
 
     def test_get_partition_from_label__respects_ROOTDELAY(self) -> None:
         """Test get_partition_from_label respects ROOTDELAY variable."""
-        self.sh_inject("ln -s /dev/null /dev/some-label")
-        self.sh_inject("ROOTDELAY=123")
+        self.sh_inject(_SOME_LABEL_SYMLINK, "ROOTDELAY=123")
         returncode, log = self.sh_run("get_partition_from_label some-label")
         self.assertEqual(returncode, 0)
         self.assertEqual(log, [b"/dev/null"])
-        self.assertEqual(self.sh_mocked_calls(), [
-            ("wait-for-root", "LABEL=some-label", "123"),
-        ])
+        self.assertEqual(
+            self.sh_mocked_calls(), _WAIT_FOR_LABEL_ROOTDELAY_CALLS)
 
     def test_get_partition_from_label__failing_wait_for_root(self) -> None:
         """Test get_partition_from_label respects ROOTDELAY variable."""
-        self.sh_inject("ln -s /dev/null /dev/some-label")
-        self.sh_inject("ROOTDELAY=123")
+        self.sh_inject(_SOME_LABEL_SYMLINK, "ROOTDELAY=123")
         self.sh_mock("wait-for-root", returns=10)
         returncode, log = self.sh_run("get_partition_from_label some-label")
         self.assertEqual(returncode, 0)
         self.assertEqual(log, [b"/dev/null"])
-        self.assertEqual(self.sh_mocked_calls(), [
-            ("wait-for-root", "LABEL=some-label", "123"),
-        ])
+        self.assertEqual(
+            self.sh_mocked_calls(), _WAIT_FOR_LABEL_ROOTDELAY_CALLS)
 
     def test_get_partition_from_label__without_label(self) -> None:
         """Test get_partition_from_label when invoked without any label."""
         returncode, log = self.sh_run("get_partition_from_label")
         self.assertEqual(returncode, 150)
         self.assertEqual(log, [])
-        self.assertEqual(self.sh_mocked_calls(), [
-            ("panic", "need FS label"),
-        ])
+        self.assertEqual(self.sh_mocked_calls(), _NEED_LABEL_CALLS)
 
     def test_get_partition_from_label__unknown_label(self) -> None:
         """Test get_partition_from_label when the label is not found."""
         returncode, log = self.sh_run("get_partition_from_label some-label")
         self.assertEqual(returncode, 0)
         self.assertEqual(log, [])
-        self.assertEqual(self.sh_mocked_calls(), [
-            ("wait-for-root", "LABEL=some-label", "180"),
-        ])
+        self.assertEqual(self.sh_mocked_calls(), _WAIT_FOR_LABEL_CALLS)
 
     def test_get_partition_from_label__broken_label(self) -> None:
         """Test get_partition_from_label when the label is a broken symlink."""
@@ -121,52 +194,29 @@ class UbuntuCoreFunctionsTests(VMShellTestCase):
         returncode, log = self.sh_run("get_partition_from_label some-label")
         self.assertEqual(returncode, 1)
         self.assertEqual(log, [])
-        self.assertEqual(self.sh_mocked_calls(), [
-            ("wait-for-root", "LABEL=some-label", "180"),
-        ])
-
-    def test_do_root_mounting__with_unset_writable_label(self) -> None:
-        """Test do_root_mounting panics when writable_label is unset."""
-        returncode, log = self.sh_run("do_root_mounting")
-        self.assertEqual(returncode, 150)
-        self.assertEqual(log, [])
-        self.assertEqual(self.sh_mocked_calls(), [
-            ("wait-for-root", "LABEL=", "180"),
-            ("panic", "root device  does not exist"),
-        ])
-
-    def test_do_root_mounting__with_failing_wait_for_root(self) -> None:
-        """Test do_root_mounting panics when writable_label is unset."""
-        self.sh_mock("wait-for-root", returns=10)
-        self.sh_inject("writable_label=some-label")
-        returncode, log = self.sh_run("do_root_mounting")
-        self.assertEqual(returncode, 150)
-        self.assertEqual(log, [])
-        self.assertEqual(self.sh_mocked_calls(), [
-            ("wait-for-root", "LABEL=some-label", "180"),
-            ("panic", "unable to find root partition LABEL=some-label"),
-        ])
+        self.assertEqual(self.sh_mocked_calls(), _WAIT_FOR_LABEL_CALLS)
 
     def test_do_root_mounting__works(self) -> None:
         """Test do_root_mounting works when writable_label is set correctly."""
-        self.sh_inject("writable_label=some-label")
-        self.sh_inject("writable_mnt=/fake-writable-mnt")
-        self.sh_inject("ln -s /dev/null /dev/some-label")
+        self.sh_inject("writable_label=some-label",
+                       "writable_mnt=/fake-writable-mnt",
+                       _SOME_LABEL_SYMLINK)
         self.sh_mock("findfs", prints="/dev/zero")
         self.sh_mock("mount")
         self.sh_mock("modprobe")
         returncode, log = self.sh_run("do_root_mounting")
         self.assertEqual(returncode, 0)
         self.assertEqual(log, [])
-        self.assertEqual(self.sh_mocked_calls(), [
-            ("wait-for-root", "LABEL=some-label", "180"),
-            ("findfs", "LABEL=some-label"),
-            ("modprobe", "squashfs"),
-            ("wait-for-root", "LABEL=some-label", "180"),
-            ("mount", "/dev/null", "/fake-writable-mnt"),
-        ])
+        self.assertEqual(self.sh_mocked_calls(), _DO_ROOT_MOUNTING_CALLS)
 
 
 if __name__ == "__main__":
-    # logging.basicConfig(level=logging.DEBUG)
-    main()
+    # Distribute tests across all CPUs, each worker boots a separate VM.
+    # Tests are handed out one class at a time so that per-class setup
+    # happens in one worker only.
+    args = [__file__, "-n", "auto", "--dist=loadscope"]
+    # Capture console and test I/O messages in verbose mode, like
+    # helpers.main() does, so that they are shown for failing tests.
+    if "-v" in sys.argv or "--verbose" in sys.argv:
+        args.append("--log-level=INFO")
+    raise SystemExit(pytest.main(args + sys.argv[1:]))
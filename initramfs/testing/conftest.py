@@ -0,0 +1,82 @@
+# Copyright (C) 2017 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Pytest integration for testing initrd scripts in qemu.
+
+Tests can be distributed across several processes with pytest-xdist. Each
+worker process boots a virtual machine of its own so that tests never share
+any guest state.
+
+Tests using :class:`helpers.VMShellTestCase` are marked with "needs_vm". The
+boot assets are built and the virtual machine is booted only when the first
+such test runs, workers that only get tests running on the host never need
+any of them.
+"""
+
+import asyncio
+import fcntl
+import os
+
+from typing import Any, Iterator, List
+
+import pytest
+
+import helpers
+
+
+def _make_boot_assets(loop: asyncio.AbstractEventLoop) -> None:
+    """Build all the boot assets, one worker process at a time."""
+    # Workers hold a lock on the Makefile while running make, the first
+    # one builds everything and make is a no-op for the others.
+    makefile = os.path.join(os.path.dirname(__file__), "Makefile")
+    with open(makefile) as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if loop.run_until_complete(helpers.TestVM().make_boot_assets()) != 0:
+            raise RuntimeError("cannot make boot assets")
+
+
+def pytest_configure(config: Any) -> None:
+    """Register the needs_vm marker and set up the event loop."""
+    config.addinivalue_line(
+        "markers", "needs_vm: the test runs in the test virtual machine")
+    helpers.setup_event_loop()
+
+
+def pytest_collection_modifyitems(items: List[Any]) -> None:
+    """Mark all the tests that use the test virtual machine."""
+    for item in items:
+        cls = getattr(item, "cls", None)
+        if cls is not None and issubclass(cls, helpers.VMShellTestCase):
+            item.add_marker(pytest.mark.needs_vm)
+
+
+@pytest.fixture(autouse=True)
+def _boot_vm_if_needed(request: Any) -> None:
+    """Boot the test VM for the first test that needs it."""
+    if "needs_vm" in request.node.keywords:
+        request.getfixturevalue("test_vm")
+
+
+@pytest.fixture(scope="session")
+def test_vm() -> Iterator[helpers.TestVM]:
+    """Boot a test VM shared by all the tests running in this process."""
+    loop = asyncio.get_event_loop()
+    _make_boot_assets(loop)
+    tvm = helpers.TestVM()
+    try:
+        helpers.boot_test_vm(loop, tvm)
+        yield tvm
+    finally:
+        helpers.shutdown_test_vm(loop, tvm)
@@ -14,52 +14,80 @@
 
 """Support code for testing initrd scripts in qemu."""
 
+import abc
 import asyncio
-import datetime
 import errno
+import functools
 import json
 import logging
 import os
+import re
 import shlex
+import shutil
 import signal
 import subprocess
 import sys
 import tempfile
+import time
 import types
 import unittest
+import weakref
 
 from typing import (
     Any,
+    Awaitable,
+    Callable,
     Dict,
     List,
     Optional,
     Sequence,
     Tuple,
     Type,
+    TypeVar,
+    Union,
     cast,
 )
 
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    def _json_loads(__data: Union[bytes, bytearray, memoryview, str]) -> Any:
+        # json.loads() only accepts bytes since Python 3.6.
+        if not isinstance(__data, str):
+            __data = bytes(__data).decode('utf-8')
+        return json.loads(__data)
+
 __all__ = ('VMShellTestCase')
 
 _logger = logging.getLogger("qemu")
 
+_T = TypeVar("_T")
+
+
+# Request echoed by the QEMU monitor: the text after the last cursor-left
+# sequence, up to the next erase-line sequence.
+_MONITOR_ECHO_RE = re.compile(rb".*\x1b\[D(.*?)\x1b\[K", re.DOTALL)
 
-O_CLOEXEC = 0x80000
+# Shell quoting of the few distinct words (file names, markers) that are
+# put into generated scripts over and over again, once per test.
+_quote = functools.lru_cache(maxsize=256)(shlex.quote)
 
 
 class Resource:
     """Host resource that needs cleanup after use."""
 
+    __slots__ = ()
+
     def cleanup(self) -> None:
         """Release the host resources associated with this object."""
 
-    def __del__(self) -> None:
-        self.cleanup()
-
 
 class FIFO(Resource):
     """Named pipe used for communication with qemu."""
 
+    __slots__ = ('_path', '_mode', '_reader', '_writer', '_transport',
+                 '_protocol', '_finalizer', '__weakref__')
+
     @classmethod
     def create(cls: Type, path: str, mode: str) -> "FIFO":
         if mode != 'r' and mode != 'w':
@@ -77,9 +105,15 @@ class FIFO(Resource):
         self._writer = None  # type: Optional[asyncio.StreamWriter]
         self._transport = None  # type: Optional[asyncio.BaseTransport]
         self._protocol = None  # type: Optional[asyncio.BaseProtocol]
+        # Remove the named pipe if the object is collected without cleanup.
+        self._finalizer = weakref.finalize(self, FIFO._unlink, path)
 
-    def __del__(self) -> None:
-        self.cleanup()
+    @staticmethod
+    def _unlink(path: str) -> None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
 
     @property
     def path(self) -> Optional[str]:
@@ -121,13 +155,13 @@ class FIFO(Resource):
                      asyncio.StreamReaderProtocol]:
         if self.path is None:
             raise ValueError("cannot open fifo when path is not set")
-        fd = os.open(self.path, os.O_NONBLOCK | O_CLOEXEC | os.O_RDONLY)
+        fd = os.open(self.path, os.O_NONBLOCK | os.O_CLOEXEC | os.O_RDONLY)
         reader = asyncio.StreamReader(loop=loop)
 
         def proto_factory() -> asyncio.StreamReaderProtocol:
             return asyncio.StreamReaderProtocol(reader, loop=loop)
         transport, protocol = await loop.connect_read_pipe(
-                proto_factory, open(fd, "rb", buffering=0))
+                proto_factory, os.fdopen(fd, "rb", buffering=0))
         return (reader, cast(asyncio.ReadTransport, transport),
                 cast(asyncio.StreamReaderProtocol, protocol))
 
@@ -136,14 +170,22 @@ class FIFO(Resource):
                      asyncio.streams.FlowControlMixin]:
         if self.path is None:
             raise ValueError("cannot open fifo when path is not set")
+        # Opening the write side fails with ENXIO until there is a reader,
+        # poll for it quickly at first and then back off.
+        #
+        # NOTE: O_RDWR would always succeed but the write pipe transport
+        # treats the pipe becoming readable as the reader going away.
         fd = None
+        delay = 0.001
         while fd is None:
             try:
                 fd = os.open(
-                    self.path, os.O_WRONLY | os.O_NONBLOCK | O_CLOEXEC)
+                    self.path, os.O_WRONLY | os.O_NONBLOCK | os.O_CLOEXEC)
             except OSError as exc:
-                if exc.errno == errno.ENXIO:
-                    await asyncio.sleep(1)
+                if exc.errno != errno.ENXIO:
+                    raise
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.1)
 
         def proto_factory() -> asyncio.streams.FlowControlMixin:
             return asyncio.streams.FlowControlMixin()
@@ -156,17 +198,15 @@ class FIFO(Resource):
         """Close and remove the named pipe from the filesystem."""
         if self._transport is not None:
             self._transport.close()
-        if self.path is not None:
-            try:
-                os.unlink(self.path)
-                self._path = None
-            except FileNotFoundError:
-                pass
+        self._finalizer()
+        self._path = None
 
 
 class CharDev:
     """QEMU character device."""
 
+    __slots__ = ('qemu_id', 'qemu_cmd', 'attrs', 'resources')
+
     def __init__(self, qemu_id: str, qemu_cmd: str, attrs: Dict[str, Any]) \
             -> None:
         """Initialize a QEMU character device."""
@@ -188,41 +228,50 @@ class CharDev:
 class Device:
     """QEMU device."""
 
+    __slots__ = ('qemu_type', 'qemu_cmd', 'attrs', '_qemu_options')
+
     def __init__(self, qemu_type: str, qemu_cmd: str, attrs: Dict[str, Any]) \
             -> None:
         """Initialize a QEMU device with given type nd command line option."""
         self.qemu_type = qemu_type
         self.qemu_cmd = qemu_cmd
         self.attrs = attrs
+        self._qemu_options = ('-device', '{},{}'.format(qemu_type, qemu_cmd))
 
     @property
     def qemu_options(self) -> Tuple[str, ...]:
         """Get the additional options to qemu executable."""
-        return ('-device', '{},{}'.format(self.qemu_type, self.qemu_cmd))
+        return self._qemu_options
 
 
 class Drive:
     """QEMU drive."""
 
+    __slots__ = ('options', '_qemu_options')
+
     def __init__(self, options: Dict[str, str]) -> None:
         """Initialize a QEMU drive with given key=value options."""
         self.options = options
+        self._qemu_options = ('-drive', ','.join(
+            '{}={}'.format(opt, value)
+            for opt, value in sorted(options.items())))
 
     @property
     def qemu_options(self) -> Tuple[str, ...]:
         """Get the additional options to qemu executable."""
-        return ('-drive', ','.join('{}={}'.format(opt, self.options[opt])
-                for opt in sorted(self.options)))
+        return self._qemu_options
 
 
 class SerialPortFIFOs:
     """QEMU serial port associated with two FIFOs."""
 
-    def __init__(self, chardev: CharDev, device: Device,
-                 attrs: Dict[str, Any]) -> None:
-        self._chardev = chardev
+    __slots__ = ('_fifo_in', '_fifo_out', '_device')
+
+    def __init__(self, fifo_in: FIFO, fifo_out: FIFO, device: Device) \
+            -> None:
+        self._fifo_in = fifo_in
+        self._fifo_out = fifo_out
         self._device = device
-        self._attrs = attrs
 
     @property
     def device(self) -> Device:
@@ -232,17 +281,17 @@ class SerialPortFIFOs:
     @property
     def guest_ttyname(self) -> str:
         """Get the name of the tty as seen by the guest (e.g. ttyS0)."""
-        return cast(str, self._device.attrs["guest-ttyname"])
+        return self._device.attrs["guest-ttyname"]
 
     @property
     def fifo_in(self) -> FIFO:
         """Get the FIFO for writing to the serial port."""
-        return cast(FIFO, self._attrs['fifo-in'])
+        return self._fifo_in
 
     @property
     def fifo_out(self) -> FIFO:
         """Get the FIFO for reading from the serial port."""
-        return cast(FIFO, self._attrs['fifo-out'])
+        return self._fifo_out
 
     @property
     def reader(self) -> Optional[asyncio.StreamReader]:
@@ -258,19 +307,21 @@ class SerialPortFIFOs:
 class MonitorFIFOs:
     """QEMU monitor associated with two FIFOs."""
 
-    def __init__(self, chardev: CharDev, attrs: Dict[str, Any]) -> None:
-        self._chardev = chardev
-        self._attrs = attrs
+    __slots__ = ('_fifo_in', '_fifo_out')
+
+    def __init__(self, fifo_in: FIFO, fifo_out: FIFO) -> None:
+        self._fifo_in = fifo_in
+        self._fifo_out = fifo_out
 
     @property
     def fifo_in(self) -> FIFO:
         """Get the FIFO for writing to the monitor."""
-        return cast(FIFO, self._attrs['fifo-in'])
+        return self._fifo_in
 
     @property
     def fifo_out(self) -> FIFO:
         """Get the FIFO for reading from the monitor."""
-        return cast(FIFO, self._attrs['fifo-out'])
+        return self._fifo_out
 
     @property
     def reader(self) -> Optional[asyncio.StreamReader]:
@@ -301,11 +352,17 @@ class Qemu:
         self._display = None  # type: Optional[str]
         # Type of QEMU monitor to use
         self._monitor = None  # type: Optional[str]
-        # Additional character devices
+        # Additional character devices, in the order they were added
         self._chardevs = {}  # type: Dict[str, CharDev]
+        self._chardev_order = []  # type: List[str]
+        # Named pipes of all the character devices, opened by start()
+        self._fifos = []  # type: List[FIFO]
         # Additional devices and drives
         self._devices = []  # type: List[Device]
         self._drives = []  # type: List[Drive]
+        self._isa_serial_count = 0
+        # Private directory for named pipes, created on demand
+        self._tmpdir = None  # type: Optional[str]
 
     @property
     def enable_kvm(self) -> bool:
@@ -332,7 +389,7 @@ class Qemu:
 
     @memory.setter
     def memory(self, value: int) -> None:
-        if 0 >= value > 4096:
+        if not 0 < value <= 4096:
             raise ValueError("cannot set memory size to {!a}".format(value))
         self._memory = value
 
@@ -397,6 +454,15 @@ class Qemu:
         for chardev in self._chardevs.values():
             for resource in chardev.resources:
                 resource.cleanup()
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+    def _ensure_tmpdir(self) -> str:
+        """Get the private temporary directory, creating it if necessary."""
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp(prefix="qemu-")
+        return self._tmpdir
 
     async def start(self, *extra_args: str) -> asyncio.subprocess.Process:
         """Start QEMU and open all named pipes."""
@@ -405,11 +471,9 @@ class Qemu:
         # Run qemu in a separate process
         proc = await asyncio.create_subprocess_exec(*args)
         # Open all the FIFOs associated with any character devices we may have.
-        for qemu_id in sorted(self._chardevs):
-            chardev = self._chardevs[qemu_id]
-            for resource in chardev.resources:
-                if isinstance(resource, FIFO):
-                    await resource.open()
+        # Writers wait for qemu to open the other end so open them all at
+        # once rather than one after another.
+        await asyncio.gather(*[fifo.open() for fifo in self._fifos])
         return proc
 
     def _qemu_cmdline(self, extra_args: Sequence[str]) -> List[str]:
@@ -435,9 +499,8 @@ class Qemu:
             args.append("-append")
             args.append(self.append)
         # Add command line arguments for all character devices.
-        for qemu_id in sorted(self._chardevs):
-            chardev = self._chardevs[qemu_id]
-            args.extend(chardev.qemu_options)
+        for qemu_id in self._chardev_order:
+            args.extend(self._chardevs[qemu_id].qemu_options)
         # Set display type if desired
         if self.display is not None:
             args.append("-display")
@@ -488,6 +551,8 @@ class Qemu:
         chardev.add_resource(fifo_in)
         chardev.add_resource(fifo_out)
         self._chardevs[qemu_id] = chardev
+        self._chardev_order.append(qemu_id)
+        self._fifos.extend((fifo_in, fifo_out))
         return chardev
 
     def remove_chardev(self, chardev: CharDev) -> None:
@@ -498,6 +563,9 @@ class Qemu:
         machine is started.
         """
         del self._chardevs[chardev.qemu_id]
+        self._chardev_order.remove(chardev.qemu_id)
+        self._fifos = [
+            fifo for fifo in self._fifos if fifo not in chardev.resources]
         for resource in chardev.resources:
             resource.cleanup()
 
@@ -515,16 +583,14 @@ class Qemu:
         if qemu_chardev_id not in self._chardevs:
             raise ValueError(
                 "cannot find chardev {!a}".format(qemu_chardev_id))
-        count = 0
-        for device in self._devices:
-            if device.qemu_type == "isa-serial":
-                count += 1
+        count = self._isa_serial_count
         if count >= 4:
             raise ValueError("cannot add more than four isa-serial devices")
         device = Device("isa-serial", "chardev={}".format(qemu_chardev_id), {
             "guest-ttyname": "ttyS{}".format(count)
         })
         self._devices.append(device)
+        self._isa_serial_count += 1
         return device
 
     def add_device_isa_debug_exit(self) -> Device:
@@ -555,26 +621,23 @@ class Qemu:
         with the serial port. The associated resources are automatically
         managed and are cleaned up when the machine terminates.
         """
-        file_name = tempfile.mktemp(prefix=qemu_id)
+        file_name = os.path.join(self._ensure_tmpdir(), qemu_id)
         chardev = self.add_chardev_pipe(qemu_id, file_name)
         try:
             device = self.add_device_isa_serial(qemu_id)
         except ValueError:
             self.remove_chardev(chardev)
-        return SerialPortFIFOs(chardev, device, {
-            "fifo-in": chardev.attrs["fifo-in"],
-            "fifo-out": chardev.attrs["fifo-out"],
-        })
+            raise
+        return SerialPortFIFOs(
+            chardev.attrs["fifo-in"], chardev.attrs["fifo-out"], device)
 
     def add_monitor_with_fifos(self, qemu_id: str='monitor') -> MonitorFIFOs:
         """Add a QEMU pipe chardev and associate it with the QEMU monitor."""
-        file_name = tempfile.mktemp(prefix=qemu_id)
+        file_name = os.path.join(self._ensure_tmpdir(), qemu_id)
         chardev = self.add_chardev_pipe(qemu_id, file_name)
         self.monitor = "chardev:{}".format(chardev.qemu_id)
-        return MonitorFIFOs(chardev, {
-            "fifo-in": chardev.attrs["fifo-in"],
-            "fifo-out": chardev.attrs["fifo-out"],
-        })
+        return MonitorFIFOs(
+            chardev.attrs["fifo-in"], chardev.attrs["fifo-out"])
 
     def add_drive(self, **opts: str) -> Drive:
         """Add a hard disk drive."""
@@ -608,7 +671,25 @@ class TestVM:
         self._proc = None  # type: Optional[asyncio.subprocess.Process]
         self._testio = None  # type: Optional[SerialPortFIFOs]
         self._console = None  # type: Optional[SerialPortFIFOs]
+        self._monitor = None  # type: Optional[MonitorFIFOs]
         self._qemu = None  # type: Optional[Qemu]
+        # Tasks reading the console and the monitor for as long as the
+        # machine runs. Console messages are appended to _console_log, if
+        # set. Lines echoing a request complete the futures waiting in
+        # _monitor_responses, in order, any other monitor output is just
+        # logged.
+        self._console_task = None  # type: Optional[asyncio.Future[None]]
+        self._monitor_task = None  # type: Optional[asyncio.Future[None]]
+        self._console_log = None  # type: Optional[List[bytes]]
+        self._monitor_responses = []  # type: List[asyncio.Future[bytes]]
+        # Name of the snapshot that matches the state of the machine. This is
+        # forgotten as soon as the machine is asked to do anything.
+        self._snapshot = None  # type: Optional[str]
+
+    @property
+    def snapshot(self) -> Optional[str]:
+        """Get the name of the snapshot the machine is known to be in."""
+        return self._snapshot
 
     def cleanup(self) -> None:
         if self._qemu is not None:
@@ -662,71 +743,106 @@ class TestVM:
         # Start qemu and process everything.
         # This should finish in a few seconds.
         self._proc = await qemu.start()
-        tasks = [
-            asyncio.ensure_future(self._booted.wait()),
-            asyncio.ensure_future(self._drain_console()),
-            asyncio.ensure_future(self._drain_monitor()),
-            asyncio.ensure_future(self._drain_testio()),
-        ]  # type: List[asyncio.Future[Any]]
+        self._console_task = asyncio.ensure_future(self._drain_console())
+        self._monitor_task = asyncio.ensure_future(self._drain_monitor())
+        testio_task = asyncio.ensure_future(self._drain_testio())
         done, pending = await asyncio.wait(
-            tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
-        # Cancel pending tasks and check if we managed to boot.
-        for task in pending:
-            task.cancel()
+            [testio_task, self._console_task, self._monitor_task],
+            timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        # Cancel the pending test I/O task and check if we managed to boot.
+        # Console and monitor keep being processed in the background.
+        if not testio_task.done():
+            testio_task.cancel()
         if not self._booted.is_set():
             raise BootError("test init process did not signal boot-ok")
 
     async def savevm(self, name: str) -> None:
         """Save snapshot of the virtual machine."""
         await self.monitor("savevm {}".format(name))
+        self._snapshot = name
 
     async def loadvm(self, name: str) -> None:
         """Load snapshot of the virtual machine."""
+        self._snapshot = None
         await self.monitor("loadvm {}".format(name))
+        self._snapshot = name
 
-    async def monitor(self, cmd: str) -> None:
+    async def monitor(self, cmd: str, timeout: int=60) -> None:
         """
         Issue a request to the QEMU monitor.
 
         :arg cmd:
             Command for the QEMU monitor.
+        :arg timeout:
+            Number of seconds to wait for the response.
         """
-        reader = self._monitor.reader
-        if reader is None:
-            raise TypeError("monitor is not ready for reading")
+        await self.monitor_pipeline([cmd], timeout)
+
+    async def monitor_pipeline(self, cmds: Sequence[str],
+                               timeout: int=60) -> None:
+        """
+        Issue a sequence of requests to the QEMU monitor.
+
+        :arg cmds:
+            Commands for the QEMU monitor.
+        :arg timeout:
+            Number of seconds to wait for the response to each command.
+
+        All the commands are sent at once and then the responses are checked
+        in order. This saves a round trip per command. The response to each
+        command is the line where the monitor echoes it. Output printed by a
+        command after that line is only logged, it is never taken for the
+        response to the next command.
+        """
+        if self._monitor is None:
+            raise TypeError("monitor is not ready")
         writer = self._monitor.writer
         if writer is None:
             raise TypeError("monitor is not ready for writing")
-
-        # Write request header and data.
-        req = '{}\n'.format(cmd).encode("utf-8")
-        _logger.info("(monitor) -> %r", req)
-        writer.write(req)
-
-        # Send request data and process console.
-        request_task = asyncio.ensure_future(writer.drain())
-        console_task = asyncio.ensure_future(self._drain_console())
+        if self._monitor_responses:
+            raise StateError("another monitor command is in progress")
+        monitor_task = self._monitor_task
+        if monitor_task is None:
+            raise StateError("monitor is not being read")
+        self._check_drain_task(monitor_task, "monitor")
+
+        # Write all the requests.
+        reqs = ['{}\n'.format(cmd).encode("utf-8") for cmd in cmds]
+        for req in reqs:
+            _logger.info("(monitor) -> %r", req)
+        responses = [
+            asyncio.Future() for req in reqs
+        ]  # type: List[asyncio.Future[bytes]]
+        self._monitor_responses.extend(responses)
         try:
-            while not request_task.done():
-                tasks = [console_task]
-                if not request_task.done():
-                    tasks.append(request_task)
-                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            writer.write(b''.join(reqs))
+            await writer.drain()
+            for req, response in zip(reqs, responses):
+                # The drain task fails pending responses when it stops, do
+                # not wait forever if it is gone or if qemu does not respond.
+                waited = [
+                    response, monitor_task
+                ]  # type: List[asyncio.Future[Any]]
+                await asyncio.wait(
+                    waited, timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not response.done():
+                    raise StateError(
+                        "monitor did not respond to {!a}".format(req))
+                self._check_monitor_response(req, response.result())
         finally:
-            if not request_task.done():
-                request_task.cancel()
-            if not console_task.done():
-                console_task.cancel()
-
-        # Read qemu response, this will contain the request as it was "typed",
-        # plus some ANSI escape codes. Just strip those out and ensure the
-        # response is what we expected. This is a poor man's way of handing the
-        # protocol intended for humans but it is good enough for this one thing
-        # we need.
-        resp = await reader.readline()
-        resp = resp[resp.rindex(b"\x1b[D") + 3:]
-        resp = resp[:resp.index(b"\x1b[K")]
-        resp += b"\n"
+            self._monitor_responses.clear()
+
+    def _check_monitor_response(self, req: bytes, resp: bytes) -> None:
+        # The qemu response contains the request as it was "typed", plus some
+        # ANSI escape codes. Just strip those out and ensure the response is
+        # what we expected. This is a poor man's way of handing the protocol
+        # intended for humans but it is good enough for this one thing we
+        # need.
+        match = _MONITOR_ECHO_RE.match(resp)
+        if match is None:
+            raise BadRequest(resp)
+        resp = match.group(1) + b"\n"
         if resp != req:
             raise BadRequest(resp)
 
@@ -743,6 +859,10 @@ class TestVM:
         await self._proc.wait()
         returncode = self._proc.returncode
         self._proc = None
+        for task in (self._console_task, self._monitor_task):
+            if task is not None and not task.done():
+                task.cancel()
+        self._console_task = self._monitor_task = None
         if self._qemu is not None:
             self._qemu.cleanup()
             self._qemu = None
@@ -766,6 +886,7 @@ class TestVM:
             Tuple (response, console_log)
         """
         console_log = []  # type: List[bytes]
+        self._snapshot = None
         if self._testio is None:
             raise TypeError("testio is not ready")
         writer = self._testio.writer
@@ -778,40 +899,27 @@ class TestVM:
         writer.write(req)
         if len(data) > 0:
             _logger.info("(test io) -> data (%d bytes)", len(data))
-            _logger.debug("(test io) << __DATA__")
-            for line in data.splitlines():
-                _logger.debug('(test io) .. %s', line)
-            _logger.debug("(test io) __DATA__")
+            if _logger.isEnabledFor(logging.DEBUG):
+                _logger.debug("(test io) << __DATA__")
+                for line in data.splitlines():
+                    _logger.debug('(test io) .. %s', line)
+                _logger.debug("(test io) __DATA__")
+            # Hand the payload to the transport as is, joining it with the
+            # header would copy all of it just to save one write call.
             writer.write(data)
 
-        # Process all I/O
-        request_task = asyncio.ensure_future(writer.drain())
-        response_task = asyncio.ensure_future(self._read_and_decode_testio())
-        console_task = asyncio.ensure_future(
-            self._drain_console(console_log if log_output else None))
-        monitor_task = asyncio.ensure_future(self._drain_monitor())
+        # Process all I/O, console and monitor messages are read in the
+        # background so just collect the console log while the request lasts.
+        if log_output:
+            self._check_drain_task(self._console_task, "console")
+            self._console_log = console_log
         try:
-            while not request_task.done() or not response_task.done():
-                tasks = []  # type: List[asyncio.Future[Any]]
-                tasks.append(console_task)
-                tasks.append(monitor_task)
-                if not request_task.done():
-                    tasks.append(request_task)
-                if not response_task.done():
-                    tasks.append(response_task)
-                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            await writer.drain()
+            response = await self._read_and_decode_testio()
         finally:
-            if not request_task.done():
-                request_task.cancel()
-            if not response_task.done():
-                response_task.cancel()
-            if not console_task.done():
-                console_task.cancel()
-            if not monitor_task.done():
-                monitor_task.cancel()
-
-        # Read response and ensure that it is OK.
-        response = response_task.result()
+            self._console_log = None
+
+        # Ensure that the response is OK.
         if response is None or response.get("result") != "ok":
             raise BadRequest(response)
 
@@ -870,10 +978,11 @@ class TestVM:
         returncode, console_log = await self.remote_system(
                 cmd, log_output=log_output)
         if returncode != 0:
+            # Like subprocess, leave the output as bytes, with one line per
+            # console message, instead of decoding it up front.
             raise subprocess.CalledProcessError(
                 returncode, cmd,
-                b''.join(console_log).decode('utf-8') if console_log else None,
-                None)
+                b'\n'.join(console_log) if console_log else None, None)
         return console_log
 
     async def remote_write(self, fname: str, mode: int, data: bytes) \
@@ -885,38 +994,109 @@ class TestVM:
             raise TypeError("expected RPC call to return a JSON object")
         return result
 
-    async def _drain_console(self, log: Optional[List[bytes]]=None) -> None:
+    async def _drain_console(self) -> None:
         """Read subsequent console messages until they stop."""
         if self._console is None:
             raise TypeError("console is not ready")
         reader = self._console.reader
         if reader is None:
             raise TypeError("console is not ready for reading")
-        while not reader.at_eof():
-            line = await reader.readline()
-            if line == b'':
-                break
-            _logger.info("(console) %s", line.rstrip(b"\r\n").decode("utf-8"))
-            if log is not None:
-                log.append(line.rstrip(b"\r\n"))
-
-    async def _drain_monitor(self, log: Optional[List[bytes]]=None) -> None:
+        log_info = _logger.isEnabledFor(logging.INFO)
+
+        def handle_line(line: bytes) -> None:
+            line = line.rstrip(b"\r\n")
+            if log_info:
+                _logger.info(
+                    "(console) %s", line.decode("utf-8", errors="replace"))
+            if self._console_log is not None:
+                self._console_log.append(line)
+        await self._drain_lines(reader, handle_line)
+
+    async def _drain_monitor(self) -> None:
         """Read subsequent QEMU monitor messages until they stop."""
         if self._monitor is None:
             raise TypeError("monitor is not ready")
         reader = self._monitor.reader
         if reader is None:
             raise TypeError("monitor is not ready for reading")
-        while not reader.at_eof():
-            line = await reader.readline()
-            if line == b'':
+        log_info = _logger.isEnabledFor(logging.INFO)
+
+        def handle_line(line: bytes) -> None:
+            if log_info:
+                _logger.info("(monitor) <- %s", line.rstrip(b"\n").decode(
+                    "utf-8", errors="replace"))
+            if (self._monitor_responses and
+                    _MONITOR_ECHO_RE.match(line) is not None):
+                response = self._monitor_responses.pop(0)
+                if not response.done():
+                    response.set_result(line)
+        error = None  # type: Optional[BaseException]
+        try:
+            await self._drain_lines(reader, handle_line)
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            # Nothing responds to pending requests once the monitor is no
+            # longer read, for whatever reason.
+            while self._monitor_responses:
+                response = self._monitor_responses.pop(0)
+                if not response.done():
+                    closed = StateError("monitor is no longer read")
+                    closed.__cause__ = error
+                    response.set_exception(closed)
+
+    @staticmethod
+    def _check_drain_task(task: Optional["asyncio.Future[None]"],
+                          name: str) -> None:
+        """Ensure that a task reading console or monitor is still running."""
+        if task is None or not task.done():
+            return
+        error = None  # type: Optional[BaseException]
+        if not task.cancelled():
+            error = task.exception()
+        raise StateError("{} is no longer read".format(name)) from error
+
+    @staticmethod
+    async def _drain_lines(reader: asyncio.StreamReader,
+                           handle_line: Callable[[bytes], None]) -> None:
+        """
+        Read lines until EOF, passing each one to a callback.
+
+        Data is read in large chunks, rather than line by line, so that a
+        burst of output, for example during boot, is processed with few
+        trips through the event loop. An incomplete last line is passed
+        along at EOF, just like readline() would return it.
+        """
+        pending = b''
+        while True:
+            data = await reader.read(65536)
+            if data == b'':
                 break
-            _logger.info("(monitor) <- %s", line.rstrip(b"\n").decode("utf-8"))
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                handle_line(line + b'\n')
+        if pending:
+            handle_line(pending)
 
     async def _drain_testio(self) -> None:
-        """Read subsequent test I/O responses until they stop."""
-        while await self._read_and_decode_testio() is not None:
-            pass
+        """
+        Read subsequent test I/O responses until boot-ok or until they stop.
+
+        Only events are acted upon so any other response is just logged,
+        without being decoded.
+        """
+        reader = self._testio_reader()
+        while not self._booted.is_set():
+            response_bytes = await reader.readline()
+            if response_bytes == b'':
+                break
+            if b'"event"' in response_bytes:
+                self._decode_testio(response_bytes)
+            elif _logger.isEnabledFor(logging.INFO):
+                _logger.info("(test io) <- %s", response_bytes.decode(
+                    'utf-8', errors='replace').rstrip())
 
     async def _read_and_decode_testio(self) -> Optional[Dict[Any, Any]]:
         """
@@ -925,17 +1105,24 @@ class TestVM:
         Responses that contain events are automatically acted upon. This is
         done so that we can observe the "boot-ok" event easily.
         """
+        response_bytes = await self._testio_reader().readline()
+        if response_bytes == b'':
+            return None
+        return self._decode_testio(response_bytes)
+
+    def _testio_reader(self) -> asyncio.StreamReader:
         if self._testio is None:
             raise TypeError("testio is not ready")
         reader = self._testio.reader
         if reader is None:
             raise TypeError("testio is not ready for reading")
-        response_bytes = await reader.readline()
-        if response_bytes == b'':
-            return None
-        response_text = response_bytes.decode('utf-8')
-        _logger.info("(test io) <- %s", response_text.rstrip())
-        decoded = json.loads(response_text)
+        return reader
+
+    def _decode_testio(self, response_bytes: bytes) -> Dict[Any, Any]:
+        if _logger.isEnabledFor(logging.INFO):
+            _logger.info("(test io) <- %s", response_bytes.decode(
+                'utf-8', errors='replace').rstrip())
+        decoded = _json_loads(response_bytes)
         if not isinstance(decoded, dict):
             raise TypeError("expected testio to return serialized JSON object")
         event = decoded.get("event")
@@ -945,142 +1132,375 @@ class TestVM:
 
 
 _tvm = None  # type: Optional[TestVM]
+_loop = None  # type: Optional[asyncio.AbstractEventLoop]
+
+
+# Shell code overriding a function or program, see _sh_mock_text().
+_SH_MOCK_TEMPLATE = """
+{cmd_neutered}() {{
+    printf '%s' '{cmd}' >>{mock_log};
+    for arg in "$@"; do
+        printf '\\037%s' "$arg" >>{mock_log};
+    done;
+    printf '\\n' >>{mock_log};
+    if [ -n "{prints}" ]; then
+        echo "{prints}";
+    fi
+    if [ {exits} -ne 0 ]; then
+        exit {exits};
+    else
+        return {returns};
+    fi
+}}
+alias {cmd}="{cmd_neutered}"
+""".strip()
+
+
+@functools.lru_cache(maxsize=256)
+def _sh_mock_text(cmd: str, exits: int, returns: int, prints: Optional[str],
+                  mock_log: str) -> str:
+    """
+    Generate shell code overriding a function or program.
+
+    Each call is logged as one line, with the name and the arguments
+    separated by the ASCII unit separator (\\037) so that no quoting is
+    needed.
+    """
+    return _SH_MOCK_TEMPLATE.format_map({
+        "cmd": cmd,
+        "cmd_neutered": cmd.replace("-", "_"),
+        "exits": exits,
+        "returns": returns,
+        "prints": shlex.quote(prints) if prints is not None else "",
+        "mock_log": _quote(mock_log),
+    })
+
+
+# Shell code printing the log of calls to mocks as the script exits, see
+# VMShellTestCase._sh_exit_trap().
+_SH_EXIT_TRAP_TEMPLATE = """
+sh_run_exit() {{
+    sh_run_rc=$?
+    echo {marker}
+    cat -- {mock_log} 2>/dev/null
+    exit $sh_run_rc
+}}
+trap sh_run_exit EXIT
+""".lstrip()
+
+
+class ShellTestCase(unittest.TestCase, metaclass=abc.ABCMeta):
+    """
+    Test case class for testing shell scripts.
+
+    The script under test is assembled from injected fragments of shell and
+    executed by :meth:`sh_run`. Subclasses decide where the script runs by
+    implementing :meth:`sh_run` and :meth:`_sh_read_mock_log`.
+    """
+
+    # Location of the log of calls to mocks, as seen by the shell.
+    _sh_mock_log = "/tmp/mock.log"
+
+    # Shell code injected by sh_setup(), recorded separately per class and
+    # already joined into one piece of text.
+    _sh_setup_text = None  # type: Optional[str]
+
+    def setUp(self) -> None:
+        """
+        Prepare for executing each test case.
+
+        This re-sets the mocking and shell injection system. Shell code
+        injected by :meth:`sh_setup` is generated once per class and then
+        replayed for each test.
+        """
+        self.sh_reset()
+        super().setUp()
 
+    def sh_reset(self) -> None:
+        """
+        Reset the shell script builder.
+
+        This discards all the shell fragments injected after
+        :meth:`sh_setup`. It is useful for running several independent cases
+        from a single test.
+        """
+        cls = type(self)
+        self._sh_lines = []  # type: List[str]
+        text = cls.__dict__.get("_sh_setup_text")
+        if text is None:
+            self.sh_inject("rm -f -- {}".format(_quote(self._sh_mock_log)))
+            self.sh_setup()
+            text = cls._sh_setup_text = "".join(
+                "{}\n".format(line) for line in self._sh_lines)
+            self._sh_lines = []
+        self._sh_setup_prefix = text
+
+    def sh_setup(self) -> None:
+        """
+        Inject shell code shared by all the tests in the class.
+
+        This is called only once per class, while preparing the first test.
+        The injected fragments are remembered and used as the starting point
+        of every test so they must not depend on any per-test state.
+        """
+
+    @abc.abstractmethod
+    def sh_run(self, fn: str) -> Tuple[int, List[bytes]]:
+        """Run a shell function."""
+
+    def sh_inject(self, *cmds: str) -> None:
+        """
+        Inject shell commands into the script builder.
 
-class VMShellTestCase(unittest.TestCase):
+        :arg cmds:
+            Shell script fragments to inject, in order.
+
+        All injected fragments are stored until they are assembled by
+        :meth:`text`. Each fragment should be a valid shell but this is not
+        checked or enforced.
+        """
+        self._sh_lines.extend(cmds)
+
+    def sh_source(self, fname: str) -> None:
+        """Source another shell script."""
+        self.sh_inject(". {}".format(_quote(fname)))
+
+    def sh_mock(self, cmd: str, exits: int=0, returns: int=0,
+                prints: Optional[str]=None) -> None:
+        """Override any function or program (buffered until execute)."""
+        self.sh_inject(_sh_mock_text(
+            cmd, exits, returns, prints, self._sh_mock_log))
+
+    def sh_mocked_calls(self) -> Tuple[Tuple[str, ...], ...]:
+        """
+        Calls and arguments to all mocks, in order.
+
+        The names of mocked commands are interned so that comparing the
+        result against expected calls is mostly a matter of identity checks.
+        """
+        lines = self._sh_read_mock_log()
+        if not lines:
+            return ()
+        # Decode everything at once, arguments may contain any character
+        # but a newline so split on that alone.
+        calls = []  # type: List[Tuple[str, ...]]
+        for line in b'\n'.join(lines).decode('utf-8').split('\n'):
+            name, *args = line.split('\x1f')
+            calls.append((sys.intern(name),) + tuple(args))
+        return tuple(calls)
+
+    @abc.abstractmethod
+    def _sh_read_mock_log(self) -> List[bytes]:
+        """Read the lines of the log of calls to mocks."""
+
+    def _sh_text(self, extra_cmds: str="") -> str:
+        """
+        Generate the complete script, appending extra commands.
+
+        :returns:
+            Each injected fragment of shell, in order, followed by
+            the contents of extra_cmds.
+
+        This function is useful to create the full script, ready to be
+        executed, while being able to reuse setup operations that are injected
+        into the script builder.
+        """
+        return "".join([self._sh_setup_prefix] + [
+            "{}\n".format(line) for line in self._sh_lines
+        ] + [extra_cmds, "\n"])
+
+
+class VMShellTestCase(ShellTestCase):
     """Test case class for testing shell scripts in a virtual machine."""
 
+    # Line printed after the script, separating its output from the log of
+    # calls to mocks.
+    _SH_END_MARKER = b"--- end of sh_run ---"
+
+    # Shell code installed by sh_run() to print the log of calls to mocks,
+    # generated once per class.
+    _sh_exit_trap_text = None  # type: Optional[str]
+
     def _tvm(self) -> TestVM:
-        global _tvm
         if _tvm is None:
-            raise ValueError("use helpers.main() to prepare test VM")
+            raise ValueError(
+                "use helpers.main() or pytest to prepare test VM")
         return _tvm
 
-    def setUp(self) -> None:
+    def _event_loop(self) -> asyncio.AbstractEventLoop:
+        if _loop is None:
+            raise ValueError(
+                "use helpers.main() or pytest to prepare test VM")
+        return _loop
+
+    def sh_reset(self) -> None:
         """
-        Prepare for executing each test case.
+        Reset the virtual machine and the shell script builder.
 
-        This loads the vanilla snapshot and re-sets the mocking and shell
-        injection system.
+        This also loads the vanilla snapshot. The snapshot is not loaded
+        again if the machine was not used since it was last restored.
         """
-        self.loadvm('vanilla')
-        self._sh_lines = []  # type: List[str]
-        self._sh_mock_log = "/tmp/mock.log"
-        self.sh_inject("rm -f -- {}".format(
-            shlex.quote(self._sh_mock_log)))
-        super().setUp()
+        if self._tvm().snapshot != 'vanilla':
+            self.loadvm('vanilla')
+        self._sh_mock_calls_log = None  # type: Optional[List[bytes]]
+        super().sh_reset()
+
+    def _sync(self, coro: Awaitable[_T]) -> _T:
+        """Run a coroutine against the test VM until it completes."""
+        return self._event_loop().run_until_complete(coro)
 
     def savevm(self, name: str) -> None:
         """Save a VM snapshot with the given name."""
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self._tvm().savevm(name))
+        self._sync(self._tvm().savevm(name))
 
     def loadvm(self, name: str) -> None:
         """Load a VM snapshot with the given name."""
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self._tvm().loadvm(name))
+        self._sync(self._tvm().loadvm(name))
 
     def ping(self) -> None:
         """Issue a no-op ping command."""
-        loop = asyncio.get_event_loop()
-        return loop.run_until_complete(self._tvm().ping())
+        return self._sync(self._tvm().ping())
 
     def remote_system(self, cmd: str, *, log_output: bool=False) \
             -> Tuple[int, List[bytes]]:
         """Run a command in a virtual machine, via system(3)."""
-        loop = asyncio.get_event_loop()
-        return loop.run_until_complete(
+        return self._sync(
                 self._tvm().remote_system(cmd, log_output=log_output))
 
     def remote_check_system(self, cmd: str, *, log_output: bool=False) \
             -> List[bytes]:
         """Run a command in a virtual machine checking for errors."""
-        loop = asyncio.get_event_loop()
-        return loop.run_until_complete(
+        return self._sync(
                 self._tvm().remote_check_system(cmd, log_output=log_output))
 
     def remote_write(self, fname: str, mode: int, data: bytes) -> None:
         """Write a file on the remote system."""
-        loop = asyncio.get_event_loop()
-        resp = loop.run_until_complete(
-                self._tvm().remote_write(fname, mode, data))
-        self.assertEqual(resp, {"result": "ok", "size": len(data)})
+        self._sync(self._remote_write(fname, mode, data))
 
     def remote_write_and_system(self, script: str, *, log_output: bool=False) \
             -> Tuple[int, List[bytes]]:
         """Write a shell script and execute it."""
-        self.remote_write("/tmp/command.sh", 0o755,
-                          "#!/bin/sh\n{}\n".format(script).encode('utf-8'))
-        return self.remote_system("/tmp/command.sh", log_output=log_output)
+        return self._sync(self._remote_write_and_system(script, log_output))
+
+    async def _remote_write(self, fname: str, mode: int, data: bytes) -> None:
+        resp = await self._tvm().remote_write(fname, mode, data)
+        self.assertEqual(resp, {"result": "ok", "size": len(data)})
+
+    async def _remote_write_and_system(self, script: str, log_output: bool) \
+            -> Tuple[int, List[bytes]]:
+        # Make both requests during a single run of the event loop.
+        await self._remote_write(
+            "/tmp/command.sh", 0o755,
+            "#!/bin/sh\n{}\n".format(script).encode('utf-8'))
+        return await self._tvm().remote_system(
+            "/tmp/command.sh", log_output=log_output)
 
     def sh_run(self, fn: str) -> Tuple[int, List[bytes]]:
-        """Run a shell function."""
-        return self.remote_write_and_system(self._sh_text(fn), log_output=True)
+        """
+        Run a shell function.
 
-    def sh_inject(self, cmd: str) -> None:
+        The script prints the log of calls to mocks when it exits, for any
+        reason, so that :meth:`sh_mocked_calls` doesn't need another round
+        trip to the virtual machine.
         """
-        Inject a shell command into the script builder.
+        returncode, log = self.remote_write_and_system(
+            self._sh_exit_trap() + self._sh_text(fn), log_output=True)
+        try:
+            end = log.index(self._SH_END_MARKER)
+        except ValueError:
+            self._sh_mock_calls_log = None
+        else:
+            log, self._sh_mock_calls_log = log[:end], log[end + 1:]
+        return returncode, log
+
+    def _sh_exit_trap(self) -> str:
+        """Generate shell code printing the mock log as the script exits."""
+        cls = type(self)
+        text = cls.__dict__.get("_sh_exit_trap_text")
+        if text is None:
+            text = cls._sh_exit_trap_text = _SH_EXIT_TRAP_TEMPLATE.format(
+                marker=_quote(self._SH_END_MARKER.decode()),
+                mock_log=_quote(self._sh_mock_log))
+        return text
+
+    def _sh_read_mock_log(self) -> List[bytes]:
+        """Read the lines of the log of calls to mocks."""
+        if self._sh_mock_calls_log is not None:
+            return self._sh_mock_calls_log
+        return self.remote_check_system(
+            "cat -- {}".format(_quote(self._sh_mock_log)),
+            log_output=True)
+
+
+class LocalShellTestCase(ShellTestCase):
+    """
+    Test case class for testing shell scripts on the host.
+
+    Scripts run in a separate instance of /bin/sh, with a private temporary
+    directory as the working directory. This is much faster than using a
+    virtual machine but it is only suitable for code that does not touch the
+    system, such as /dev or /proc, in any way.
+
+    Scripts sourced from /scripts are taken from the source tree instead.
+    """
+
+    SCRIPTS_DIR = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, "scripts")
+
+    # Temporary directory shared by all the tests in the class.
+    _tmpdir = ""
 
-        :arg cmd:
-            A shell script fragment to inject.
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls._tmpdir = tempfile.mkdtemp(prefix="shell-test-")
+        cls._sh_mock_log = os.path.join(cls._tmpdir, "mock.log")
+        # Shell setup from an earlier run refers to a removed directory.
+        cls._sh_setup_text = None
 
-        All injected fragments are stored until they are assembled by
-        :meth:`text`. Each fragment should be a valid shell but this is not
-        checked or enforced.
-        """
-        self._sh_lines.append(cmd)
+    @classmethod
+    def tearDownClass(cls) -> None:
+        shutil.rmtree(cls._tmpdir, ignore_errors=True)
+        super().tearDownClass()
 
     def sh_source(self, fname: str) -> None:
-        """Source another shell script."""
-        self.sh_inject(". {}".format(shlex.quote(fname)))
-
-    def sh_mock(self, cmd: str, exits: int=0, returns: int=0,
-                prints: Optional[str]=None) -> None:
-        """Override any function or program (buffered until execute)."""
-        self.sh_inject("""
-            {cmd_neutered}() {{
-                printf '%s' '{cmd}' >>{mock_log};
-                for arg in "$@"; do
-                    printf " '%s'" "$arg" >>{mock_log};
-                done;
-                printf '\\n' >>{mock_log};
-                if [ -n "{prints}" ]; then
-                    echo "{prints}";
-                fi
-                if [ {exits} -ne 0 ]; then
-                    exit {exits};
-                else
-                    return {returns};
-                fi
-            }}
-            alias {cmd}="{cmd_neutered}"
-        """.format(
-            cmd=cmd, cmd_neutered=cmd.replace("-", "_"),
-            exits=exits, returns=returns,
-            prints=shlex.quote(prints) if prints is not None else "",
-            mock_log=shlex.quote(self._sh_mock_log),
-        ).strip())
-
-    def sh_mocked_calls(self) -> List[Tuple[str, ...]]:
-        """List of calls and arguments to all mocks."""
-        return [tuple(shlex.split(line.decode('utf-8')))
-                for line in self.remote_check_system(
-                    "cat -- {}".format(shlex.quote(self._sh_mock_log)),
-                    log_output=True)]
+        """Source another shell script, from the source tree if possible."""
+        if fname.startswith("/scripts/"):
+            # Some scripts source each other via ${scriptsroot}.
+            self.sh_inject("scriptsroot={}".format(_quote(self.SCRIPTS_DIR)))
+            fname = os.path.join(self.SCRIPTS_DIR, fname[len("/scripts/"):])
+        super().sh_source(fname)
 
-    def _sh_text(self, extra_cmds: str="") -> str:
-        """
-        Generate the complete script, appending extra commands.
+    def sh_run(self, fn: str) -> Tuple[int, List[bytes]]:
+        """Run a shell function."""
+        # Like init in the test VM, start from a clean environment so that
+        # variables exported on the host cannot leak into the script. Don't
+        # let a hung script block the whole test run.
+        proc = subprocess.run(
+            ["/bin/sh", "-c", self._sh_text(fn)], cwd=self._tmpdir,
+            env={"PATH": os.environ.get("PATH", os.defpath)},
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60)
+        return proc.returncode, proc.stdout.splitlines()
+
+    def _sh_read_mock_log(self) -> List[bytes]:
+        """Read the lines of the log of calls to mocks."""
+        try:
+            with open(self._sh_mock_log, "rb") as stream:
+                return stream.read().splitlines()
+        except FileNotFoundError:
+            # No mock was called.
+            return []
 
-        :returns:
-            Each injected fragment of shell, in order, followed by
-            the contents of extra_cmds.
 
-        This function is useful to create the full script, ready to be
-        executed, while being able to reuse setup operations that are injected
-        into the script builder.
-        """
-        return "\n".join(self._sh_lines) + "\n" + extra_cmds + "\n"
+# Entries expected in the output of mount(8) whose sizes vary between runs.
+_MOUNT_ROOTFS_RE = re.compile(
+    r"rootfs on / type rootfs \(rw,size=[0-9]+k,nr_inodes=[0-9]+\)")
+_MOUNT_DEV_RE = re.compile(
+    r"udev on /dev type devtmpfs \(rw,nosuid,relatime,size=[0-9]+k,"
+    r"nr_inodes=[0-9]+,mode=755\)")
+_MOUNT_RUN_RE = re.compile(
+    r"tmpfs on /run type tmpfs \(rw,nosuid,noexec,relatime,"
+    r"size=[0-9]+k,mode=755\)")
 
 
 class SmokeTests(VMShellTestCase):
@@ -1093,38 +1513,29 @@ class SmokeTests(VMShellTestCase):
     def test_mount(self) -> None:
         """Check that essential filesystems are mounted."""
         output = self.remote_check_system("mount", log_output=True)
-        self.assertRegex(
-            output.pop(0).decode(),
-            r"rootfs on / type rootfs \(rw,size=[0-9]+k,nr_inodes=[0-9]+\)")
+        self.assertRegex(output.pop(0).decode(), _MOUNT_ROOTFS_RE)
         self.assertEqual(
             output.pop(0).decode(),
             "sysfs on /sys type sysfs (rw,nosuid,nodev,noexec,relatime)")
         self.assertEqual(
             output.pop(0).decode(),
             "proc on /proc type proc (rw,nosuid,nodev,noexec,relatime)")
-        self.assertRegex(
-            output.pop(0).decode(),
-            r"udev on /dev type devtmpfs \(rw,nosuid,relatime,size=[0-9]+k,"
-            r"nr_inodes=[0-9]+,mode=755\)")
+        self.assertRegex(output.pop(0).decode(), _MOUNT_DEV_RE)
         self.assertEqual(
             output.pop(0).decode(),
             "devpts on /dev/pts type devpts (rw,nosuid,noexec,relatime,"
             "gid=5,mode=620,ptmxmode=000)")
-        self.assertRegex(
-            output.pop(0).decode(),
-            r"tmpfs on /run type tmpfs \(rw,nosuid,noexec,relatime,"
-            r"size=[0-9]+k,mode=755\)")
+        self.assertRegex(output.pop(0).decode(), _MOUNT_RUN_RE)
         self.assertEqual(output, [])
 
     def test_synchronized_time(self) -> None:
         """Check that the time inside the VM is synchronized with the host."""
-        output = self.remote_check_system("date", log_output=True)
+        output = self.remote_check_system("date +%s", log_output=True)
         self.assertEqual(len(output), 1)
-        now_vm = datetime.datetime.strptime(
-                output.pop().decode(), "%a %b %d %H:%M:%S %Z %Y")
-        now_here = datetime.datetime.utcnow()
+        now_vm = int(output.pop())
+        now_here = time.time()
         # Allow for five seconds of delta
-        self.assertLess((now_here - now_vm).total_seconds(), 5)
+        self.assertLess(now_here - now_vm, 5)
 
     def test_remote_write(self) -> None:
         """Check that we can write arbitrary binary data."""
@@ -1160,9 +1571,66 @@ class SmokeTests(VMShellTestCase):
     def test_mocking_works(self) -> None:
         self.sh_mock("foo")
         self.sh_run("foo 1 2 3")
-        self.assertEqual(self.sh_mocked_calls(), [
+        self.assertEqual(self.sh_mocked_calls(), (
             ("foo", "1", "2", "3"),
-        ])
+        ))
+
+
+class LocalSmokeTests(LocalShellTestCase):
+    """Smoke tests for the host based testing system."""
+
+    def test_mocking_works(self) -> None:
+        self.sh_mock("foo")
+        self.sh_run("foo 1 2 3")
+        self.assertEqual(self.sh_mocked_calls(), (
+            ("foo", "1", "2", "3"),
+        ))
+
+
+def setup_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Create the event loop used for talking to the test VM.
+
+    The loop is provided by uvloop, if available, as libuv is faster at the
+    pipe and subprocess I/O that this module does. The new loop is set as
+    the current event loop.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+def boot_test_vm(loop: asyncio.AbstractEventLoop, tvm: TestVM) -> None:
+    """
+    Boot the test VM and make it available to :class:`VMShellTestCase`.
+
+    The virtual machine is snapshotted right after boot so that each test can
+    start from the same, pristine, state.
+    """
+    global _tvm, _loop
+    loop.run_until_complete(tvm.boot())
+    # Save snapshot after boot
+    loop.run_until_complete(tvm.savevm('vanilla'))
+    # We are now ready to run tests :-)
+    _tvm = tvm
+    _loop = loop
+
+
+def shutdown_test_vm(loop: asyncio.AbstractEventLoop, tvm: TestVM) -> None:
+    """Stop the test VM and release all the associated host resources."""
+    global _tvm, _loop
+    _tvm = None
+    _loop = None
+    try:
+        loop.run_until_complete(tvm.shutdown())
+    finally:
+        tvm.cleanup()
 
 
 def main() -> None:
@@ -1174,7 +1642,7 @@ def main() -> None:
             verbose = True
     logging.basicConfig(level=logging.INFO if verbose else logging.WARNING)
     # Prepare a VM for testing
-    loop = asyncio.get_event_loop()
+    loop = setup_event_loop()
     loop.add_signal_handler(signal.SIGINT, lambda: None)
     tvm = TestVM()
     try:
@@ -1183,19 +1651,12 @@ def main() -> None:
             raise SystemError("cannot make boot assets")
         # Boot the VM
         try:
-            loop.run_until_complete(tvm.boot())
+            boot_test_vm(loop, tvm)
         except BootError as exc:
             raise SystemExit(str(exc))
-        # Save snapshot after boot
-        loop.run_until_complete(tvm.savevm('vanilla'))
-        # We are now ready to run tests :-)
-        global _tvm
-        _tvm = tvm
         unittest.main()
-        _tvm = None
     finally:
-        loop.run_until_complete(tvm.shutdown())
-        tvm.cleanup()
+        shutdown_test_vm(loop, tvm)
 
 
 if __name__ == "__main__":